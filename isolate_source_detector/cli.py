@@ -39,12 +39,20 @@ def print_version(ctx, param, value):
               expose_value=False, is_eager=True)
 @click.option("--num_processes", "-n", default=4, type=int,
               help="Number of processes to execute ISD using.")
+@click.option("--mash_batch_size", "-b", default=1, type=click.IntRange(min=1),
+              help="Number of isolates to query per mash dist call, larger "
+                   "batches load the reference sketch fewer times.")
+@click.option("--distance_engine", default='mash',
+              type=click.Choice(['mash', 'native']),
+              help="Compute mash distances with the mash executable or the "
+                   "built-in native MinHash engine (no external binary).")
 def main(isolates, metadata, fasta, tree, traits, output_dir,
-         debug, num_processes):
+         debug, num_processes, mash_batch_size, distance_engine):
     """Console script for isolate_source_detector"""
 
     isolate_source_detector.isd(isolates, metadata, fasta, tree,
-                                traits, output_dir, debug, num_processes)
+                                traits, output_dir, debug, num_processes,
+                                mash_batch_size, distance_engine)
     return 0
 
 
@@ -1,121 +1,270 @@
 import logging
+import heapq
+import itertools
 import tqdm
 import subprocess
 import sys
+import tempfile
+import numpy as np
 import pandas as pd
 import pickle
-from io import StringIO
 from multiprocessing import Pool
 
-def older_leaves_for_isolate(input_data):
+from isolate_source_detector import minhash
+
+# read-only structures shared with each worker process once by the pool
+# initializer so individual tasks only need to carry an isolate name
+_WORKER_DATA = {}
+
+
+def init_worker(shared_data):
+    """
+    Pool initializer storing the shared read-only inputs in the worker
+    """
+    _WORKER_DATA.clear()
+    _WORKER_DATA.update(shared_data)
+
+
+def chunksize_for(num_tasks, num_processes):
     """
-    Inner loop worker for parallelising extract of older leaves for a specific
-    isolate
+    Dispatch tasks in a few chunks per worker to amortise IPC overhead
     """
-    # extract input data
-    isolate, tree_metadata, tree = input_data
+    return max(1, num_tasks // (num_processes * 4))
 
-    #get metadata for all strains in tree older than query isolate
-    strain_date = tree_metadata.loc[isolate, 'date']
-    metadata_older = tree_metadata[tree_metadata['date'] < strain_date]
-    older_strains = set(metadata_older.index)
 
-    # for each leaf in the tree if its an older node get the distance
-    # to the isolate node
+def nearest_older_leaves(isolate_node, older_strains, tolerance=1e-9):
+    """
+    Branch-and-bound search for the leaves in older_strains closest to
+    isolate_node by phylogenetic distance.
+
+    Expands outwards from the isolate node along tree edges in order of
+    distance and stops once the nearest unexplored node is further away than
+    the best older leaf found, as nothing past it can be closer. Returns all
+    leaves tied (within floating point tolerance) for the smallest distance.
+    """
+    isolate = isolate_node.name
+    tiebreak = itertools.count()
+    frontier = [(0.0, next(tiebreak), isolate_node, None)]
+    best = None
+    candidates = []
+    while frontier:
+        distance, _, node, previous = heapq.heappop(frontier)
+        if best is not None and distance > best + tolerance * max(1.0, best):
+            break
+
+        if node.is_leaf() and node.name != isolate \
+                and node.name in older_strains:
+            if best is None:
+                best = distance
+            candidates.append(node)
+            continue
+
+        # tree so the only way back is the node we came from
+        for neighbour in node.children:
+            if neighbour is not previous:
+                heapq.heappush(frontier, (distance + neighbour.dist,
+                                          next(tiebreak), neighbour, node))
+        if node.up is not None and node.up is not previous:
+            heapq.heappush(frontier, (distance + node.dist,
+                                      next(tiebreak), node.up, node))
+    return candidates
+
+
+def older_leaves_for_isolate(isolate):
+    """
+    Inner loop worker for parallelising extract of closest older leaves for a
+    specific isolate
+    """
+    # shared input data set up by init_worker
+    date_index = _WORKER_DATA['date_index']
+    tree = _WORKER_DATA['tree']
+    leaf_order = _WORKER_DATA['leaf_order']
+
+    # view of all strains older than query isolate (tree leaves absent from
+    # the metadata are never older)
+    older_strains = date_index.older_than(isolate)
+
+    # search outwards from the isolate node for the closest older leaves
     isolate_node = tree.search_nodes(name=isolate)[0]
-    isolate_tree_distances = {'isolate': [], 'closest_ancestor': [],
-                              'metric': [], 'distance': []}
-    for leaf in tree.iter_leaves():
-        if leaf.name in older_strains and leaf.name != isolate:
-            isolate_tree_distances['isolate'].append(isolate)
-            isolate_tree_distances['closest_ancestor'].append(leaf.name)
-            distance = tree.get_distance(isolate_node, leaf)
-            isolate_tree_distances['metric'].append('phylo_distance')
-            isolate_tree_distances['distance'].append(distance)
-
-    if len(isolate_tree_distances['distance']) == 0:
+    candidates = nearest_older_leaves(isolate_node, older_strains)
+
+    if len(candidates) == 0:
         logging.error(f"Could not find older strain in tree to {isolate}")
         sys.exit(1)
-    else:
-        return pd.DataFrame(isolate_tree_distances)
 
+    # report the exact ete3 distances for the handful of candidates so ties
+    # and values match a full get_distance scan, in tree leaf order
+    distances = {leaf.name: tree.get_distance(isolate_node, leaf) \
+                    for leaf in candidates}
+    min_distance = min(distances.values())
+    closest_leaves = sorted([leaf for leaf, distance in distances.items() \
+                                if distance == min_distance],
+                            key=leaf_order.get)
 
-def get_closest_older_leaves_in_tree(isolates, tree, metadata, num_processes):
+    isolate_tree_distances = {'isolate': [isolate] * len(closest_leaves),
+                              'closest_ancestor': closest_leaves,
+                              'metric': ['phylo_distance'] * len(closest_leaves),
+                              'distance': [min_distance] * len(closest_leaves)}
+    return pd.DataFrame(isolate_tree_distances)
+
+
+def get_closest_older_leaves_in_tree(isolates, tree, date_index, num_processes):
     """
     For each isolate find all nearest sequences in the tree with older
     collection dates than the input sample
     """
-    # get just metadata for strains in tree
-    leaf_names = set([strain for strain in tree.iter_leaf_names() \
-                        if not strain.startswith('unknown')])
+    # position of each leaf in the tree so tied hits are reported in order
+    leaf_order = {leaf: ix for ix, leaf in enumerate(tree.iter_leaf_names())}
 
-    # i.e. for augur tree "strain"
-    tree_metadata = metadata.loc[leaf_names]
+    # parallelise, sending the tree and date index to each worker once
+    shared_data = {'tree': tree, 'date_index': date_index,
+                   'leaf_order': leaf_order}
+    isolates = list(isolates)
+    with Pool(num_processes, initializer=init_worker,
+              initargs=(shared_data,)) as pool:
+        tree_distances = pool.map(older_leaves_for_isolate, isolates,
+                                  chunksize=chunksize_for(len(isolates),
+                                                          num_processes))
 
-    # parallelise
-    pool = Pool(num_processes)
-    parallel_input = [(isolate, tree_metadata, tree) for isolate in isolates]
-    tree_distances = pool.map(older_leaves_for_isolate, parallel_input)
-    pool.close()
+    # workers only return the closest (tied) older leaves for each isolate
+    closest_older_strains = pd.concat(tree_distances, ignore_index=True)
 
-    tree_distances = pd.concat(tree_distances)
+    return closest_older_strains
 
-    # get closest relatives for each isolate
-    # can't use idxmin because want to keep minimum ties
-    min_ix = tree_distances.groupby('isolate')['distance']\
-                    .nsmallest(1, keep='all').reset_index()['level_1'].values
-    closest_older_strains = tree_distances.loc[min_ix]
 
-    return closest_older_strains
+class ClosestHits:
+    """
+    Running reduction keeping only the closest hits (with ties) seen so far
+    for each isolate, so memory is bounded by the number of isolates rather
+    than the number of hits
+    """
+    def __init__(self, metric):
+        self.metric = metric
+        self.best = {}
+
+    def add(self, isolate, hit, distance):
+        current = self.best.get(isolate)
+        if current is None or distance < current[0]:
+            self.best[isolate] = (distance, [hit])
+        elif distance == current[0]:
+            current[1].append(hit)
+
+    def to_frame(self):
+        data = {'isolate': [], 'closest_ancestor': [], 'metric': [],
+                'distance': []}
+        for isolate, (distance, hits) in self.best.items():
+            data['isolate'].extend([isolate] * len(hits))
+            data['closest_ancestor'].extend(hits)
+            data['metric'].extend([self.metric] * len(hits))
+            data['distance'].extend([distance] * len(hits))
+        return pd.DataFrame(data)
 
 
-def older_mash_for_isolate(input_data):
+def older_mash_for_batch(batch):
     """
-    Inner loop for parallelising mash across isolates without ending up with
-    a 60GB mash dist file containing all hits
+    Inner loop for parallelising mash across batches of isolates without
+    ending up with a 60GB mash dist file containing all hits.
+
+    Runs one mash dist for the whole batch (so the reference sketch is loaded
+    once per batch) and streams its output line by line, keeping only the
+    closest older hits for each isolate.
     """
-    isolate, isolate_fasta, metadata, ref_sketch = input_data
+    # shared input data set up by init_worker
+    isolate_fasta_index = _WORKER_DATA['isolate_fasta_index']
+    date_index = _WORKER_DATA['date_index']
+    ref_sketch = _WORKER_DATA['ref_sketch']
+
+    # mash reports each query by its fasta path
+    path_to_isolate = {str(isolate_fasta_index[isolate]): isolate \
+                        for isolate in batch}
+    older_strains = {isolate: date_index.older_than(isolate) \
+                        for isolate in batch}
 
-    result = subprocess.run(f"mash dist -p 1 {ref_sketch} {isolate_fasta} 2> /dev/null",
-                             stdout=subprocess.PIPE,
-                             shell=True,
-                             check=True)
+    closest_hits = ClosestHits('mash')
+    with tempfile.NamedTemporaryFile('w', suffix='.txt') as query_list:
+        query_list.write("\n".join(path_to_isolate) + "\n")
+        query_list.flush()
 
-    isolate_hits = pd.read_csv(StringIO(result.stdout.decode('utf8')),
-                              sep='\t', names=["closest_ancestor",
-                                               "isolate",
-                                               "distance",
-                                               "p-value",
-                                               "shared-hashes"])
-    # filter out self-hits
-    isolate_hits = isolate_hits[isolate_hits['isolate'] != isolate_hits['closest_ancestor']]
-    isolate_hits['metric'] = 'mash'
-    # overwrite isolate name to replace fasta path with just isolate name
-    isolate_hits['isolate'] = isolate
+        mash_cmd = ['mash', 'dist', '-p', '1', '-l', str(ref_sketch),
+                    query_list.name]
+        with subprocess.Popen(mash_cmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              encoding='utf-8') as mash:
+            for line in mash.stdout:
+                ref, query, distance = line.split('\t', 3)[:3]
+                isolate = path_to_isolate[query]
+                # filter out self-hits and any hits that aren't older
+                if ref == isolate or ref not in older_strains[isolate]:
+                    continue
+                closest_hits.add(isolate, ref, float(distance))
 
-    isolate_date = metadata.loc[isolate, 'date']
-    older_strains = set(metadata[metadata['date'] < isolate_date].index)
-    older_isolate_hits = isolate_hits[isolate_hits['closest_ancestor'].isin(older_strains)]
+    if mash.returncode != 0:
+        raise subprocess.CalledProcessError(mash.returncode, mash_cmd)
 
-    top_hit_ix = older_isolate_hits['distance'].nsmallest(1, keep='all').index
-    top_hits = older_isolate_hits.loc[top_hit_ix, ['isolate', 'closest_ancestor',
-                                                   'metric', 'distance']]
-    return top_hits
+    return closest_hits.to_frame()
 
 
-def get_closest_older_genomes(isolate_fasta_index, ref_sketch, metadata,
-                              output_dir, num_processes):
+def older_native_for_batch(batch):
     """
-    Use mash to get closest older genomes to isolate genomes via minimap2
+    Inner loop for the native MinHash engine: sketch each isolate and compute
+    its mash distance to every older reference sketch in one vectorised pass
     """
-    # parallelise
-    pool = Pool(num_processes)
-    parallel_input = [(isolate, isolate_path, metadata, ref_sketch) \
-                        for isolate, isolate_path in isolate_fasta_index.items()]
-    mash_distances = pool.map(older_mash_for_isolate, parallel_input)
-    pool.close()
+    # shared input data set up by init_worker
+    isolate_fasta_index = _WORKER_DATA['isolate_fasta_index']
+    date_index = _WORKER_DATA['date_index']
+    ref_sketch = _WORKER_DATA['ref_sketch']
+    ref_ordinals = _WORKER_DATA['ref_ordinals']
+
+    closest_hits = ClosestHits('mash')
+    for isolate in batch:
+        isolate_date = date_index.ordinal_of(isolate)
+        if isolate_date == date_index.MISSING:
+            continue
+        # only older references (which excludes self-hits) are compared
+        rows = np.flatnonzero(ref_ordinals < isolate_date)
+        if len(rows) == 0:
+            continue
+
+        query, _ = minhash.sketch_query_fasta(isolate_fasta_index[isolate],
+                                              ref_sketch)
+        distances, _, _ = minhash.distances_to(query, ref_sketch, rows)
+        min_distance = distances.min()
+        for row in rows[distances == min_distance]:
+            closest_hits.add(isolate, ref_sketch.names[row],
+                             float(min_distance))
+
+    return closest_hits.to_frame()
+
+
+def get_closest_older_genomes(isolate_fasta_index, ref_sketch, date_index,
+                              output_dir, num_processes, batch_size=1,
+                              distance_engine='mash'):
+    """
+    Use mash (or the native MinHash engine) to get closest older genomes to
+    isolate genomes, querying batch_size isolates per mash dist call
+    """
+    isolates = list(isolate_fasta_index)
+    batches = [isolates[ix: ix + batch_size] \
+                for ix in range(0, len(isolates), batch_size)]
+
+    # parallelise, sending the date index to each worker once
+    shared_data = {'isolate_fasta_index': isolate_fasta_index,
+                   'date_index': date_index, 'ref_sketch': ref_sketch}
+    worker = older_mash_for_batch
+    if distance_engine == 'native':
+        # memory-mapped so workers share the reference hashes
+        ref_sketch = minhash.Sketch.load(ref_sketch)
+        shared_data['ref_sketch'] = ref_sketch
+        shared_data['ref_ordinals'] = date_index.ordinals_for(ref_sketch.names)
+        worker = older_native_for_batch
+
+    with Pool(num_processes, initializer=init_worker,
+              initargs=(shared_data,)) as pool:
+        mash_distances = pool.map(worker, batches,
+                                  chunksize=chunksize_for(len(batches),
+                                                          num_processes))
 
-    closest_older_mash_hits = pd.concat(mash_distances)
+    closest_older_mash_hits = pd.concat(mash_distances, ignore_index=True)
 
     return closest_older_mash_hits
 
@@ -125,19 +274,19 @@ def get_ancestor_traits(present_isolates, tree, traits):
     Extract ancestor traits from augur's inferred traits json dictionary
     """
     data = {'isolate': [], 'trait_type': [],
-            'trait': []}
+            'trait_value': []}
     for isolate in present_isolates:
         node = tree.search_nodes(name=isolate)[0]
         node = node.up
         ancestor_traits = traits[node.name]
 
-	for trait in ['region', 'country', 'division']:
-	    data['isolate'].append(isolate)
-	    data['trait_type'].append(trait)
-	    data['trait_value'].append(ancestor_traits[trait])
-	    # add exposure trait too
-	    data['isolate'].append(isolate)
-	    data['trait_type'].append(trait + "_exposure")
-	    data['trait_value'].append(ancestor_traits[trait + "_exposure"])
+        for trait in ['region', 'country', 'division']:
+            data['isolate'].append(isolate)
+            data['trait_type'].append(trait)
+            data['trait_value'].append(ancestor_traits[trait])
+            # add exposure trait too
+            data['isolate'].append(isolate)
+            data['trait_type'].append(trait + "_exposure")
+            data['trait_value'].append(ancestor_traits[trait + "_exposure"])
 
     return pd.DataFrame(data)
@@ -7,14 +7,15 @@ from pathlib import Path
 from isolate_source_detector import utils, closest
 
 def isd(isolates_fp, metadata_fp, fasta_fp, tree_fp, traits_fp,
-        output_dir, debug, num_processes):
+        output_dir, debug, num_processes, mash_batch_size=1,
+        distance_engine='mash'):
     """
     Main runner for ISD: finds closest relatives of isolates
     in both refined augur phylogeny and using minimap
     """
     output_dir = Path(output_dir)
     utils.set_up_logging(output_dir, debug)
-    utils.check_dependencies()
+    utils.check_dependencies(distance_engine)
     utils.set_up_output_dir(output_dir)
 
     # get all metadata and data structure set up
@@ -29,6 +30,7 @@ def isd(isolates_fp, metadata_fp, fasta_fp, tree_fp, traits_fp,
     #
     logging.info(f"Parsing input metadata: {metadata_fp}")
     metadata = utils.parse_metadata(metadata_fp)
+    date_index = utils.DateIndex(metadata)
 
     logging.info(f"Parsing input traits: {traits_fp}")
     traits = utils.parse_traits(traits_fp)
@@ -52,16 +54,19 @@ def isd(isolates_fp, metadata_fp, fasta_fp, tree_fp, traits_fp,
 
 
     logging.info(f"Sketching input fastas: {fasta_fp}")
-    ref_sketch = utils.mash_sketch_input_fasta(fasta_fp, output_dir, num_processes)
+    ref_sketch = utils.mash_sketch_input_fasta(fasta_fp, output_dir, num_processes,
+                                               distance_engine)
 
     # for each isolate find closest older genomes using mash
     logging.info(f"Searching {ref_sketch} using mash sketch of all isolates "
                  "for closest relatives to isolates")
     closest_older_in_mash = closest.get_closest_older_genomes(present_isolate_fasta_index,
                                                               ref_sketch,
-                                                              metadata,
+                                                              date_index,
                                                               output_dir,
-                                                              num_processes)
+                                                              num_processes,
+                                                              mash_batch_size,
+                                                              distance_engine)
 
     closest_older_in_mash = utils.add_geo_location_from_metadata(closest_older_in_mash,
                                                                  metadata)
@@ -75,7 +80,7 @@ def isd(isolates_fp, metadata_fp, fasta_fp, tree_fp, traits_fp,
                  f"{tree_fp}")
     closest_older_in_tree = closest.get_closest_older_leaves_in_tree(present_isolates,
                                                                      tree,
-                                                                     metadata,
+                                                                     date_index,
                                                                      num_processes)
     closest_older_in_tree = utils.add_geo_location_from_metadata(closest_older_in_tree,
                                                                  metadata)
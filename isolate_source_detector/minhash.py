@@ -0,0 +1,362 @@
+"""
+In-process MinHash engine reproducing `mash sketch` and `mash dist`
+
+K-mers are hashed with the first 64 bits of MurmurHash3_x64_128 (seed 42)
+of the lexicographically smaller of the k-mer and its reverse complement,
+skipping k-mers containing anything other than ACGT, exactly as mash does.
+Each sketch is the sorted bottom-s unique hashes and the distances are
+mash's Jaccard estimate from the bottom-s of the union of two sketches.
+"""
+import json
+import math
+import logging
+from pathlib import Path
+from multiprocessing import Pool
+
+import numpy as np
+from Bio import SeqIO
+
+# mash defaults
+KMER_SIZE = 21
+SKETCH_SIZE = 1000
+SEED = 42
+
+# padding for sketches with fewer than sketch_size hashes
+EMPTY = np.uint64(np.iinfo(np.uint64).max)
+
+_C1 = np.uint64(0x87c37b91114253d5)
+_C2 = np.uint64(0x4cf5ad432745937f)
+
+_VALID = np.zeros(256, dtype=bool)
+_VALID[np.frombuffer(b'ACGT', dtype=np.uint8)] = True
+_COMPLEMENT = bytes.maketrans(b'ACGT', b'TGCA')
+
+
+def _rotl64(x, r):
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def _fmix64(k):
+    k ^= k >> np.uint64(33)
+    k *= np.uint64(0xff51afd7ed558ccd)
+    k ^= k >> np.uint64(33)
+    k *= np.uint64(0xc4ceb9fe1a85ec53)
+    k ^= k >> np.uint64(33)
+    return k
+
+
+def _lane(kmers, start, stop):
+    """
+    Little-endian uint64 from up to 8 bytes of each row of kmers
+    """
+    lane = np.zeros(len(kmers), dtype=np.uint64)
+    for shift, column in enumerate(range(start, stop)):
+        lane |= kmers[:, column].astype(np.uint64) << np.uint64(8 * shift)
+    return lane
+
+
+def murmur3_64(kmers, seed=SEED):
+    """
+    First 64 bits of MurmurHash3_x64_128 for every row of a (n, k) uint8
+    array of k-mers, vectorised over rows
+    """
+    num_kmers, length = kmers.shape
+    h1 = np.full(num_kmers, seed, dtype=np.uint64)
+    h2 = np.full(num_kmers, seed, dtype=np.uint64)
+
+    with np.errstate(over='ignore'):
+        num_blocks = length // 16
+        for block in range(num_blocks):
+            k1 = _lane(kmers, 16 * block, 16 * block + 8)
+            k2 = _lane(kmers, 16 * block + 8, 16 * block + 16)
+
+            k1 *= _C1
+            k1 = _rotl64(k1, 31)
+            k1 *= _C2
+            h1 ^= k1
+            h1 = _rotl64(h1, 27)
+            h1 += h2
+            h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+
+            k2 *= _C2
+            k2 = _rotl64(k2, 33)
+            k2 *= _C1
+            h2 ^= k2
+            h2 = _rotl64(h2, 31)
+            h2 += h1
+            h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+
+        tail = 16 * num_blocks
+        tail_length = length - tail
+        if tail_length > 8:
+            k2 = _lane(kmers, tail + 8, length)
+            k2 *= _C2
+            k2 = _rotl64(k2, 33)
+            k2 *= _C1
+            h2 ^= k2
+        if tail_length > 0:
+            k1 = _lane(kmers, tail, min(tail + 8, length))
+            k1 *= _C1
+            k1 = _rotl64(k1, 31)
+            k1 *= _C2
+            h1 ^= k1
+
+        h1 ^= np.uint64(length)
+        h2 ^= np.uint64(length)
+        h1 += h2
+        h2 += h1
+        h1 = _fmix64(h1)
+        h2 = _fmix64(h2)
+        h1 += h2
+    return h1
+
+
+def kmer_hashes(sequence, kmer_size=KMER_SIZE, seed=SEED,
+                chunk_size=1000000):
+    """
+    Hashes of all canonical ACGT-only k-mers of a sequence (str or bytes)
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii', 'replace')
+    sequence = sequence.upper()
+    num_kmers = len(sequence) - kmer_size + 1
+    if num_kmers < 1:
+        return np.zeros(0, dtype=np.uint64)
+
+    forward = np.frombuffer(sequence, dtype=np.uint8)
+    reverse = np.frombuffer(sequence.translate(_COMPLEMENT)[::-1],
+                            dtype=np.uint8)
+
+    # k-mers containing a non-ACGT character are skipped
+    invalid = np.concatenate([[0], np.cumsum(~_VALID[forward])])
+    valid = (invalid[kmer_size:] - invalid[:-kmer_size]) == 0
+
+    forward_kmers = np.lib.stride_tricks.sliding_window_view(forward,
+                                                             kmer_size)
+    # reverse complement of the k-mer starting at i is at len - i - k
+    reverse_kmers = np.lib.stride_tricks.sliding_window_view(reverse,
+                                                             kmer_size)[::-1]
+
+    hashes = []
+    for start in range(0, num_kmers, chunk_size):
+        stop = min(start + chunk_size, num_kmers)
+        keep = np.flatnonzero(valid[start:stop]) + start
+        if len(keep) == 0:
+            continue
+        fwd = forward_kmers[keep]
+        rev = reverse_kmers[keep]
+
+        # canonical k-mer is the lexicographically smaller (memcmp <= 0)
+        differs = fwd != rev
+        first = differs.argmax(axis=1)
+        rows = np.arange(len(keep))
+        use_forward = ~differs.any(axis=1) | \
+            (fwd[rows, first] < rev[rows, first])
+        canonical = np.where(use_forward[:, None], fwd, rev)
+        hashes.append(murmur3_64(canonical, seed))
+
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return np.concatenate(hashes)
+
+
+def sketch_sequence(sequence, kmer_size=KMER_SIZE, sketch_size=SKETCH_SIZE,
+                    seed=SEED):
+    """
+    Bottom-s MinHash sketch (sorted unique uint64 hashes) of a sequence
+    """
+    hashes = np.unique(kmer_hashes(sequence, kmer_size, seed))
+    return hashes[:sketch_size]
+
+
+class Sketch:
+    """
+    Collection of bottom-s sketches stored as one padded (n, sketch_size)
+    uint64 array along with each sketch's name, hash count and sequence
+    length.
+
+    Saved as a directory of .npy arrays so that it can be memory-mapped and
+    shared between worker processes through the page cache.
+    """
+    def __init__(self, names, hashes, counts, lengths,
+                 kmer_size=KMER_SIZE, sketch_size=SKETCH_SIZE, seed=SEED):
+        self.names = list(names)
+        self.hashes = hashes
+        self.counts = counts
+        self.lengths = lengths
+        self.kmer_size = kmer_size
+        self.sketch_size = sketch_size
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_sketches(cls, names, sketches, lengths, kmer_size=KMER_SIZE,
+                      sketch_size=SKETCH_SIZE, seed=SEED):
+        """
+        Pack individual sorted hash arrays into a padded sketch collection
+        """
+        hashes = np.full((len(sketches), sketch_size), EMPTY, dtype=np.uint64)
+        counts = np.zeros(len(sketches), dtype=np.int64)
+        for row, sketch in enumerate(sketches):
+            hashes[row, :len(sketch)] = sketch
+            counts[row] = len(sketch)
+        return cls(names, hashes, counts,
+                   np.asarray(lengths, dtype=np.int64),
+                   kmer_size, sketch_size, seed)
+
+    def params(self):
+        return {'kmer_size': self.kmer_size, 'sketch_size': self.sketch_size,
+                'seed': self.seed}
+
+    def save(self, sketch_dir):
+        sketch_dir = Path(sketch_dir)
+        sketch_dir.mkdir(parents=True, exist_ok=True)
+        np.save(sketch_dir / "hashes.npy", self.hashes)
+        np.save(sketch_dir / "counts.npy", self.counts)
+        np.save(sketch_dir / "lengths.npy", self.lengths)
+        with open(sketch_dir / "names.txt", 'w') as fh:
+            fh.write("".join(f"{name}\n" for name in self.names))
+        with open(sketch_dir / "params.json", 'w') as fh:
+            json.dump(self.params(), fh)
+
+    @classmethod
+    def load(cls, sketch_dir, mmap_mode='r'):
+        sketch_dir = Path(sketch_dir)
+        with open(sketch_dir / "params.json") as fh:
+            params = json.load(fh)
+        with open(sketch_dir / "names.txt") as fh:
+            names = fh.read().splitlines()
+        return cls(names,
+                   np.load(sketch_dir / "hashes.npy", mmap_mode=mmap_mode),
+                   np.load(sketch_dir / "counts.npy"),
+                   np.load(sketch_dir / "lengths.npy"),
+                   **params)
+
+
+def _sketch_record(record_data):
+    """
+    Pool worker sketching a single (name, sequence, params) record
+    """
+    name, sequence, kmer_size, sketch_size, seed = record_data
+    return name, sketch_sequence(sequence, kmer_size, sketch_size, seed), \
+        len(sequence)
+
+
+def sketch_fasta(fasta_fp, sketch_dir, num_processes,
+                 kmer_size=KMER_SIZE, sketch_size=SKETCH_SIZE, seed=SEED):
+    """
+    Native equivalent of `mash sketch -i`: sketch every record of a fasta
+    individually and save the collection to sketch_dir
+    """
+    records = ((record.id, bytes(record.seq), kmer_size, sketch_size, seed) \
+                for record in SeqIO.parse(str(fasta_fp), "fasta"))
+    names, sketches, lengths = [], [], []
+    with Pool(num_processes) as pool:
+        for name, sketch, length in pool.imap(_sketch_record, records,
+                                              chunksize=64):
+            names.append(name)
+            sketches.append(sketch)
+            lengths.append(length)
+
+    sketch = Sketch.from_sketches(names, sketches, lengths, kmer_size,
+                                  sketch_size, seed)
+    sketch.save(sketch_dir)
+    logging.debug(f"Sketched {len(sketch)} sequences to {sketch_dir}")
+    return sketch
+
+
+def jaccard_counts(query, ref_hashes, ref_counts, sketch_size):
+    """
+    Shared and total hash counts within the bottom-s of the union of one
+    query sketch and every reference sketch, in a single vectorised pass.
+
+    Equivalent to mash's merge of two sorted sketches: for each reference
+    hash, its rank in the union is its rank in the reference plus the number
+    of query hashes at or below it minus the shared hashes at or below it.
+    """
+    ref_hashes = np.asarray(ref_hashes)
+    positions = np.arange(ref_hashes.shape[1])
+    valid = positions[None, :] < ref_counts[:, None]
+
+    below = np.searchsorted(query, ref_hashes, side='right')
+    in_query = (below > 0) & \
+        (query[np.maximum(below - 1, 0)] == ref_hashes) if len(query) \
+        else np.zeros(ref_hashes.shape, dtype=bool)
+    in_query &= valid
+
+    shared_below = np.cumsum(in_query, axis=1)
+    union_rank = positions[None, :] + 1 + below - shared_below
+    common = np.sum(in_query & (union_rank <= sketch_size), axis=1)
+
+    total_shared = shared_below[:, -1] if ref_hashes.shape[1] else 0
+    union_size = ref_counts + len(query) - total_shared
+    denom = np.minimum(sketch_size, union_size)
+    return common, denom
+
+
+def mash_distance(common, denom, kmer_size):
+    """
+    Mash distance from shared/total bottom-s hash counts
+    """
+    common = np.asarray(common, dtype=float)
+    denom = np.asarray(denom, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jaccard = common / denom
+        distance = -np.log(2 * jaccard / (1 + jaccard)) / kmer_size
+    distance = np.where(common == 0, 1.0, distance)
+    distance = np.where(common == denom, 0.0, distance)
+    return distance
+
+
+def mash_p_value(common, ref_length, query_length, kmer_size, sketch_size):
+    """
+    Mash's probability of observing `common` shared hashes by chance
+    """
+    if common == 0:
+        return 1.0
+    kmer_space = 4.0 ** kmer_size
+    p_x = 1.0 / (1.0 + kmer_space / ref_length)
+    p_y = 1.0 / (1.0 + kmer_space / query_length)
+    r = p_x * p_y / (p_x + p_y - p_x * p_y)
+    trials = int(min(kmer_space * (p_x + p_y) / (1 + r), sketch_size))
+    if common > trials:
+        return 0.0
+    # upper binomial tail P(X >= common)
+    log_terms = [math.lgamma(trials + 1) - math.lgamma(i + 1) -
+                 math.lgamma(trials - i + 1) + i * math.log(r) +
+                 (trials - i) * math.log1p(-r) \
+                    for i in range(common, trials + 1)]
+    return math.fsum(math.exp(term) for term in log_terms)
+
+
+def distances_to(query, ref_sketch, rows=None, chunk_size=4096):
+    """
+    Mash distances and shared/total counts from one query sketch to the
+    given rows (default all) of a reference Sketch, in chunks of rows
+    """
+    if rows is None:
+        rows = np.arange(len(ref_sketch))
+    common = np.zeros(len(rows), dtype=np.int64)
+    denom = np.zeros(len(rows), dtype=np.int64)
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start: start + chunk_size]
+        common[start: start + chunk_size], denom[start: start + chunk_size] = \
+            jaccard_counts(query, ref_sketch.hashes[chunk],
+                           ref_sketch.counts[chunk], ref_sketch.sketch_size)
+    return mash_distance(common, denom, ref_sketch.kmer_size), common, denom
+
+
+def sketch_query_fasta(fasta_fp, ref_sketch):
+    """
+    Sketch all records of a query fasta together (as `mash dist` does for a
+    query file) using the reference sketch's parameters
+    """
+    sequences = [bytes(record.seq) for record in
+                 SeqIO.parse(str(fasta_fp), "fasta")]
+    # k-mers don't span records so hash each and combine
+    hashes = np.unique(np.concatenate(
+        [kmer_hashes(sequence, ref_sketch.kmer_size, ref_sketch.seed) \
+            for sequence in sequences] + [np.zeros(0, dtype=np.uint64)]))
+    return hashes[:ref_sketch.sketch_size], sum(map(len, sequences))
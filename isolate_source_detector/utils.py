@@ -7,15 +7,20 @@ import time
 import json
 import tqdm
 from pathlib import Path
+import numpy as np
 import pandas as pd
 from Bio import SeqIO
 
-def check_dependencies():
+from isolate_source_detector import minhash
+
+def check_dependencies(distance_engine='mash'):
     """
-    Check all dependencies exist and work
+    Check all dependencies exist and work (the native distance engine
+    doesn't need any external tools)
     """
     missing=False
-    for program in ['mash']:
+    programs = ['mash'] if distance_engine == 'mash' else []
+    for program in programs:
         try:
             output = subprocess.run(program, shell=True, check=True,
                     stdout=subprocess.PIPE, encoding='utf-8')
@@ -66,11 +71,111 @@ def set_up_output_dir(output_dir):
 def parse_metadata(metadata_fp):
     # nextstrain metadata
     metadata = pd.read_csv(metadata_fp, sep='\t')
-    metadata['date'] = pd.to_datetime(metadata['date'].str.replace('-XX', ''))
+    metadata['date'] = pd.to_datetime(metadata['date'].str.replace('-XX', ''),
+                                      format='ISO8601')
     metadata = metadata.set_index('strain')
     return metadata
 
 
+def date_ordinal(date):
+    """
+    Convert a date (or array of dates) to int64 day ordinals
+    """
+    return np.asarray(date, dtype='datetime64[D]').astype(np.int64)
+
+
+class OlderStrains:
+    """
+    Lightweight view of the strains in a DateIndex collected before a given
+    day ordinal, supporting `strain in older_strains` without building a set
+    """
+    def __init__(self, date_index, ordinal):
+        self.date_index = date_index
+        self.ordinal = ordinal
+
+    def __contains__(self, strain):
+        return self.ordinal != DateIndex.MISSING and \
+            self.date_index.ordinal_of(strain) < self.ordinal
+
+    def __len__(self):
+        return self.date_index.count_older(self.ordinal)
+
+
+class DateIndex:
+    """
+    Date-sorted index over parsed metadata so "older than" queries are a
+    binary search rather than a scan of the whole metadata frame.
+
+    Strains with missing dates are never considered older than anything
+    and have nothing older than them.
+    """
+    MISSING = np.iinfo(np.int64).max
+
+    def __init__(self, metadata):
+        self.strains = metadata.index
+        ordinals = date_ordinal(metadata['date'].values)
+        ordinals[pd.isnull(metadata['date']).values] = self.MISSING
+        self.ordinals = ordinals
+        self.sorted_positions = np.argsort(ordinals, kind='stable')
+        self.sorted_ordinals = ordinals[self.sorted_positions]
+        dated = ordinals != self.MISSING
+        self._ordinal_lookup = dict(zip(self.strains[dated],
+                                        ordinals[dated].tolist()))
+
+    def ordinal_of(self, strain):
+        """
+        Day ordinal for a strain (MISSING if absent or undated)
+        """
+        return self._ordinal_lookup.get(strain, self.MISSING)
+
+    def ordinals_for(self, strains):
+        """
+        Day ordinals for a sequence of strains (MISSING if absent or undated)
+        """
+        found = pd.Series(strains).map(self._ordinal_lookup).to_numpy(dtype=float)
+        ordinals = np.full(len(found), self.MISSING, dtype=np.int64)
+        present = ~np.isnan(found)
+        ordinals[present] = found[present].astype(np.int64)
+        return ordinals
+
+    def count_older(self, ordinal):
+        """
+        Number of strains collected strictly before the day ordinal
+        """
+        if ordinal == self.MISSING:
+            return 0
+        return int(np.searchsorted(self.sorted_ordinals, ordinal, side='left'))
+
+    def older_positions(self, ordinal):
+        """
+        Metadata row positions of strains collected before the day ordinal
+        """
+        return self.sorted_positions[:self.count_older(ordinal)]
+
+    def older_mask(self, ordinal):
+        """
+        Boolean mask over metadata rows for strains older than day ordinal
+        """
+        mask = np.zeros(len(self.ordinals), dtype=bool)
+        mask[self.older_positions(ordinal)] = True
+        return mask
+
+    def older_than(self, strain):
+        """
+        View of all strains older than the named strain
+        """
+        return OlderStrains(self, self.ordinal_of(strain))
+
+    def is_older(self, strains, ordinal):
+        """
+        Vectorised check of which of the supplied strains are older than the
+        day ordinal
+        """
+        if ordinal == self.MISSING:
+            return np.zeros(len(strains), dtype=bool)
+        return self.ordinals_for(strains) < ordinal
+
+
 def parse_tree(tree_fp):
     """
     Parse newick tree (from augur or a global phylogeny)
@@ -225,7 +330,17 @@ def check_input_consistency(isolates, metadata, traits, tree, fasta_strains):
     return present_isolates
 
 
-def mash_sketch_input_fasta(fasta_fp, output_dir, num_processes):
+def mash_sketch_input_fasta(fasta_fp, output_dir, num_processes,
+                            distance_engine='mash'):
+    """
+    Sketch each sequence in the input fasta with mash or the native engine
+    """
+    if distance_engine == 'native':
+        ref_sketch = output_dir / Path(fasta_fp).with_suffix('.sketch').name
+        logging.info(f"Sketching {fasta_fp} to {ref_sketch}")
+        minhash.sketch_fasta(fasta_fp, ref_sketch, num_processes)
+        return ref_sketch
+
     # sketch input _files
     ref_sketch = output_dir / Path(fasta_fp).with_suffix('.msh').name
     logging.info(f"Sketching {fasta_fp} to {ref_sketch}")
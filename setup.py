@@ -8,7 +8,7 @@ from isolate_source_detector import __version__
 with open('README.md') as readme_file:
     readme = readme_file.read()
 
-requirements = ['Click>=7.0', "Biopython", "tqdm", "ete3", "pandas"]
+requirements = ['Click>=7.0', "Biopython", "tqdm", "ete3", "pandas", "numpy"]
 
 setup_requirements = ['pytest-runner', ]
 
@@ -0,0 +1,68 @@
+"""Shared fixtures for isolate_source_detector tests."""
+
+import json
+import random
+
+import ete3
+import pytest
+
+
+@pytest.fixture
+def synthetic_inputs(tmp_path):
+    """
+    Small consistent set of augur-style inputs: a tree with named internal
+    nodes, traits for every node, metadata and a fasta of genomes evolved
+    down the tree
+    """
+    rng = random.Random(0)
+    tree = ete3.Tree()
+    tree.populate(30, names_library=[f"strain_{ix}" for ix in range(30)],
+                  random_branches=True)
+    locations = ['Canada', 'USA', 'Mexico']
+
+    sequences = {}
+    traits = {}
+    metadata = []
+    for ix, node in enumerate(tree.traverse('preorder')):
+        if not node.is_leaf():
+            node.name = f"NODE_{ix:07d}"
+        if node.up is None:
+            sequence = [rng.choice('ACGT') for _ in range(2000)]
+        else:
+            sequence = list(sequences[node.up.name])
+            for _ in range(rng.randint(1, 20)):
+                sequence[rng.randrange(len(sequence))] = rng.choice('ACGT')
+        sequences[node.name] = sequence
+
+        country = rng.choice(locations)
+        traits[node.name] = {}
+        for trait in ['region', 'country', 'division']:
+            traits[node.name][trait] = f"{trait}_{country}"
+            traits[node.name][trait + "_exposure"] = f"{trait}_{country}"
+            traits[node.name][trait + "_confidence"] = {country: 1.0}
+
+        if node.is_leaf():
+            metadata.append((node.name, f"2020-{rng.randint(1, 12):02d}-XX"
+                                        if ix % 5 == 0 else
+                                        f"2020-{rng.randint(1, 12):02d}-"
+                                        f"{rng.randint(1, 28):02d}",
+                             'North America', country, f"{country}_division"))
+
+    paths = {'tree': tmp_path / "tree.nwk",
+             'traits': tmp_path / "traits.json",
+             'metadata': tmp_path / "metadata.tsv",
+             'fasta': tmp_path / "sequences.fasta",
+             'isolates': tmp_path / "isolates.txt"}
+    tree.write(outfile=str(paths['tree']), format=1, format_root_node=True)
+    with open(paths['traits'], 'w') as fh:
+        json.dump({'nodes': traits}, fh, indent=1)
+    with open(paths['metadata'], 'w') as fh:
+        fh.write("strain\tdate\tregion\tcountry\tdivision\n")
+        for row in metadata:
+            fh.write("\t".join(row) + "\n")
+    with open(paths['fasta'], 'w') as fh:
+        for leaf in tree.iter_leaf_names():
+            fh.write(f">{leaf}\n{''.join(sequences[leaf])}\n")
+    with open(paths['isolates'], 'w') as fh:
+        fh.write("\n".join(sorted(tree.get_leaf_names())[:10]) + "\n")
+    return paths
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""Tests for `isolate_source_detector.closest`."""
+
+import os
+import random
+
+import ete3
+import pandas as pd
+import pytest
+
+from isolate_source_detector import closest, utils
+
+
+@pytest.fixture
+def tree_and_metadata():
+    """Random tree with some tied branch lengths and random leaf dates."""
+    random.seed(42)
+    tree = ete3.Tree()
+    tree.populate(200, random_branches=True)
+    for ix, node in enumerate(tree.traverse()):
+        if not node.is_leaf():
+            node.name = f"NODE_{ix}"
+        # force a few exact ties between sister leaves
+        elif ix % 7 == 0:
+            node.dist = 0.5
+    dates = pd.to_datetime('2020-01-01') + \
+        pd.to_timedelta([random.randint(0, 30) for _ in tree.iter_leaves()],
+                        unit='D')
+    metadata = pd.DataFrame({'date': dates},
+                            index=pd.Index(tree.get_leaf_names(),
+                                           name='strain'))
+    return tree, metadata
+
+
+def brute_force_closest(tree, metadata, isolate):
+    """Original all-leaves get_distance scan"""
+    isolate_node = tree.search_nodes(name=isolate)[0]
+    older = set(metadata[metadata['date'] < metadata.loc[isolate, 'date']].index)
+    distances = pd.Series({leaf.name: tree.get_distance(isolate_node, leaf)
+                           for leaf in tree.iter_leaves()
+                           if leaf.name in older and leaf.name != isolate},
+                          dtype=float)
+    return distances.nsmallest(1, keep='all')
+
+
+def test_older_leaves_matches_brute_force(tree_and_metadata):
+    tree, metadata = tree_and_metadata
+    leaf_order = {leaf: ix for ix, leaf in enumerate(tree.iter_leaf_names())}
+    closest.init_worker({'tree': tree, 'leaf_order': leaf_order,
+                         'date_index': utils.DateIndex(metadata)})
+    oldest = metadata['date'].min()
+    for isolate in metadata.index:
+        if metadata.loc[isolate, 'date'] == oldest:
+            continue
+        expected = brute_force_closest(tree, metadata, isolate)
+        result = closest.older_leaves_for_isolate(isolate)
+        assert list(result['closest_ancestor']) == list(expected.index)
+        assert list(result['distance']) == list(expected.values)
+        assert set(result['isolate']) == {isolate}
+
+
+def test_nearest_older_leaves_none_older(tree_and_metadata):
+    tree, _ = tree_and_metadata
+    isolate_node = next(tree.iter_leaves())
+    assert closest.nearest_older_leaves(isolate_node, set()) == []
+
+
+def test_get_closest_older_leaves_in_tree_pool(tree_and_metadata):
+    tree, metadata = tree_and_metadata
+    isolates = list(metadata.sort_values('date').index[-10:])
+    result = closest.get_closest_older_leaves_in_tree(isolates, tree,
+                                                      utils.DateIndex(metadata),
+                                                      2)
+    for isolate in isolates:
+        expected = brute_force_closest(tree, metadata, isolate)
+        hits = result[result['isolate'] == isolate]
+        assert list(hits['closest_ancestor']) == list(expected.index)
+
+
+@pytest.fixture
+def fake_mash(tmp_path, monkeypatch):
+    """
+    Stand-in mash on PATH whose dist prints fixed distances from each
+    reference to every query in the -l list
+    """
+    script = tmp_path / "bin" / "mash"
+    script.parent.mkdir()
+    script.write_text(
+        "#!/usr/bin/env python\n"
+        "import sys\n"
+        "refs = {'old_a': 0.2, 'old_b': 0.1, 'old_c': 0.1, 'new': 0.0,\n"
+        "        'q1': 0.0, 'q2': 0.05}\n"
+        "for query in open(sys.argv[-1]).read().split():\n"
+        "    for ref, dist in refs.items():\n"
+        "        print(f'{ref}\\t{query}\\t{dist}\\t0\\t1/1000')\n")
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{script.parent}:{os.environ['PATH']}")
+    return script
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_get_closest_older_genomes_streams_batches(fake_mash, tmp_path,
+                                                   batch_size):
+    metadata = pd.DataFrame({'date': pd.to_datetime(['2020-01-01', '2020-01-02',
+                                                     '2020-01-03', '2020-03-01',
+                                                     '2020-02-01', '2020-02-02'])},
+                            index=pd.Index(['old_a', 'old_b', 'old_c', 'new',
+                                            'q1', 'q2'], name='strain'))
+    isolate_fasta_index = {'q1': tmp_path / 'q1', 'q2': tmp_path / 'q2'}
+    result = closest.get_closest_older_genomes(isolate_fasta_index,
+                                               tmp_path / 'ref.msh',
+                                               utils.DateIndex(metadata),
+                                               tmp_path, 2, batch_size)
+    result = result.sort_values(['isolate', 'closest_ancestor'])
+    assert list(result['isolate']) == ['q1', 'q1', 'q2']
+    assert list(result['closest_ancestor']) == ['old_b', 'old_c', 'q1']
+    assert list(result['distance']) == [0.1, 0.1, 0.0]
+    assert set(result['metric']) == {'mash'}
@@ -2,6 +2,7 @@
 
 """Tests for `isolate_source_detector` package."""
 
+import pandas as pd
 import pytest
 
 from click.testing import CliRunner
@@ -35,3 +36,19 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+def test_isd_native_engine(synthetic_inputs, tmp_path, monkeypatch):
+    """Run the whole pipeline on synthetic inputs without the mash binary"""
+    monkeypatch.chdir(tmp_path)
+    output_dir = tmp_path / "out"
+    inputs = {name: str(path) for name, path in synthetic_inputs.items()}
+    isolate_source_detector.isd(inputs['isolates'], inputs['metadata'],
+                                inputs['fasta'], inputs['tree'],
+                                inputs['traits'],
+                                output_dir, False, 2,
+                                distance_engine='native')
+    for output in ['mash.tsv', 'phylo_distance.tsv', 'inferred_traits.tsv']:
+        assert (output_dir / output).exists()
+    traits = pd.read_csv(output_dir / "inferred_traits.tsv", sep='\t')
+    assert len(traits) == 6 * traits['isolate'].nunique()
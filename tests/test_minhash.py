@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Tests for `isolate_source_detector.minhash`."""
+
+import random
+import shutil
+import subprocess
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from isolate_source_detector import minhash
+
+
+def merge_counts(ref, query, sketch_size):
+    """mash's pairwise merge of two sorted sketches"""
+    i = j = common = denom = 0
+    while denom < sketch_size and i < len(ref) and j < len(query):
+        if ref[i] < query[j]:
+            i += 1
+        elif ref[i] > query[j]:
+            j += 1
+        else:
+            i += 1
+            j += 1
+            common += 1
+        denom += 1
+    if denom < sketch_size:
+        if i < len(ref):
+            denom += min(sketch_size - denom, len(ref) - i)
+        if j < len(query):
+            denom += min(sketch_size - denom, len(query) - j)
+    return common, denom
+
+
+def test_murmur3_64_known_values():
+    # first 64 bits of MurmurHash3_x64_128 with mash's seed of 42
+    kmers = np.frombuffer(b'ACGTACGTACGTACGTACGTA' b'AAAAAAAAAAAAAAAAAAAAA',
+                          dtype=np.uint8).reshape(2, 21)
+    assert list(minhash.murmur3_64(kmers, 42)) == [0xb4e9c495b633d387,
+                                                   0xfbf127446a821b6f]
+
+
+def test_kmer_hashes_canonical_and_skip_invalid():
+    rng = random.Random(1)
+    sequence = "".join(rng.choice('ACGT') for _ in range(500))
+    complement = str.maketrans('ACGT', 'TGCA')
+    reverse_complement = sequence.translate(complement)[::-1]
+    assert np.array_equal(np.sort(minhash.kmer_hashes(sequence)),
+                          np.sort(minhash.kmer_hashes(reverse_complement)))
+    # lower case is treated as upper case and Ns split k-mers
+    assert np.array_equal(minhash.kmer_hashes(sequence.lower()),
+                          minhash.kmer_hashes(sequence))
+    with_n = sequence[:250] + 'N' + sequence[251:]
+    assert len(minhash.kmer_hashes(with_n)) == len(sequence) - 20 - 21
+
+
+def test_jaccard_counts_matches_pairwise_merge():
+    rng = np.random.default_rng(0)
+    sketch_size = 50
+    universe = np.arange(400, dtype=np.uint64) * 7
+    sketches = [np.unique(rng.choice(universe, rng.integers(0, 80)))[:sketch_size]
+                for _ in range(100)]
+    refs = minhash.Sketch.from_sketches(range(100), sketches, [1] * 100,
+                                        sketch_size=sketch_size)
+    for query in [np.unique(rng.choice(universe, 70))[:sketch_size],
+                  np.zeros(0, dtype=np.uint64)]:
+        common, denom = minhash.jaccard_counts(query, refs.hashes, refs.counts,
+                                               sketch_size)
+        for row, sketch in enumerate(sketches):
+            assert (common[row], denom[row]) == \
+                merge_counts(sketch, query, sketch_size)
+
+
+def test_sketch_save_load_round_trip(tmp_path, synthetic_inputs):
+    sketch = minhash.sketch_fasta(synthetic_inputs['fasta'],
+                                  tmp_path / "refs.sketch", 2)
+    loaded = minhash.Sketch.load(tmp_path / "refs.sketch")
+    assert loaded.names == sketch.names
+    assert np.array_equal(loaded.hashes, sketch.hashes)
+    assert loaded.params() == sketch.params()
+    distances, common, denom = minhash.distances_to(loaded.hashes[0][:loaded.counts[0]],
+                                                    loaded)
+    assert distances[0] == 0
+    assert common[0] == denom[0] == loaded.counts[0]
+
+
+@pytest.mark.skipif(shutil.which('mash') is None,
+                    reason="mash executable not installed")
+def test_distances_match_mash(tmp_path, synthetic_inputs):
+    fasta = synthetic_inputs['fasta']
+    subprocess.run(['mash', 'sketch', '-i', str(fasta), '-o',
+                    str(tmp_path / "refs")], check=True)
+    result = subprocess.run(['mash', 'dist', str(tmp_path / "refs.msh"),
+                             str(fasta), '-i'], check=True,
+                            stdout=subprocess.PIPE, encoding='utf-8')
+    expected = pd.read_csv(StringIO(result.stdout), sep='\t',
+                           names=['ref', 'query', 'distance', 'p-value',
+                                  'shared-hashes'])
+
+    sketch = minhash.sketch_fasta(fasta, tmp_path / "refs.sketch", 1)
+    for row, name in enumerate(sketch.names):
+        query = sketch.hashes[row][:sketch.counts[row]]
+        distances, common, denom = minhash.distances_to(query, sketch)
+        hits = expected[expected['query'] == name].set_index('ref')
+        for ref_row, ref in enumerate(sketch.names):
+            assert hits.loc[ref, 'shared-hashes'] == \
+                f"{common[ref_row]}/{denom[ref_row]}"
+            assert hits.loc[ref, 'distance'] == \
+                pytest.approx(distances[ref_row], rel=1e-5, abs=1e-6)
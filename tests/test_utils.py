@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+"""Tests for `isolate_source_detector.utils`."""
+
+import numpy as np
+import pandas as pd
+
+from isolate_source_detector import utils
+
+
+def test_date_index_matches_metadata_scan():
+    metadata = pd.DataFrame({'date': pd.to_datetime(['2020-03-01', '2020-01-05',
+                                                     None, '2020-02-10',
+                                                     '2020-01-05'])},
+                            index=pd.Index(['a', 'b', 'c', 'd', 'e'],
+                                           name='strain'))
+    date_index = utils.DateIndex(metadata)
+
+    for strain in metadata.index:
+        date = metadata.loc[strain, 'date']
+        expected = set(metadata[metadata['date'] < date].index)
+        ordinal = date_index.ordinal_of(strain)
+        older = set(metadata.index[date_index.older_positions(ordinal)])
+        assert older == expected
+        assert set(metadata.index[date_index.older_mask(ordinal)]) == expected
+        view = date_index.older_than(strain)
+        assert {s for s in metadata.index if s in view} == expected
+        assert len(view) == len(expected)
+        assert list(date_index.is_older(list(metadata.index) + ['missing'],
+                                        ordinal)) == \
+            [s in expected for s in metadata.index] + [False]
+
+
+def test_date_ordinal():
+    assert utils.date_ordinal(pd.Timestamp('1970-01-03')) == 2
+    assert list(utils.date_ordinal(np.array(['1970-01-01', '1970-02-01'],
+                                            dtype='datetime64[D]'))) == [0, 31]